@@ -357,10 +357,12 @@ class V4L2Manager(CameraManager):
 			if self.supported_formats:
 				pixelformats = [x['pixelformat'] for x in self.supported_formats]
 
-				for o in desired['cameraOutput']:
-					if 	(o['value'] == 'x-mjpeg' and 'MJPG' not in pixelformats) or \
-						(o['value'] == 'x-raw' and 'YUYV' not in pixelformats) :
-							desired['cameraOutput'].remove(o)
+				#_desiredSettings can be cached by the manager, so filter on a copy
+				desired = dict(desired)
+				desired['cameraOutput'] = [o for o in desired['cameraOutput'] if not (
+					(o['value'] == 'x-mjpeg' and 'MJPG' not in pixelformats) or
+					(o['value'] == 'x-raw' and 'YUYV' not in pixelformats)
+				)]
 
 				return desired
 
@@ -6,7 +6,8 @@ import logging
 import time
 import uuid
 
-from threading import Event, Condition, Lock
+from functools import partial
+from threading import Condition, Lock
 
 from octoprint.events import eventManager, Events
 
@@ -26,16 +27,55 @@ class GStreamerManager(V4L2Manager):
 		self.pipeline = None
 		self.cameraInfo = None
 		self._openCameraCondition = Condition()
+		self._pipelineStateCondition = Condition()
+		self._pipelineStateResp = None
+		self._pipelineStateReqId = 0
 		self.eventManager = eventManager()
+		self._webRtc = webRtcManager()
 
 		self._logger = logging.getLogger(__name__)
 
 		super(GStreamerManager, self).__init__()
 
-		self._localPeers = []
-		self._localFrame = None
+		self._cachedCapabilities = ['videoStreaming', 'videoformat-' + self._settings['encoding']]
+		self._cachedDesiredSettings = {
+			'busSource': [
+				{'value': 'USB', 'label': 'USB Camera'},
+				{'value': 'raspicam', 'label': 'Raspicam'}
+			],
+			'frameSizes': [
+				{'value': '640x480', 'label': 'Low (640 x 480)'},
+				{'value': '1280x720', 'label': 'HD 720p (1280 x 720)'},
+				{'value': '1920x1080', 'label': 'HD 1080p (1920 x 1080)'}
+			],
+			'cameraOutput': [
+				{'value': 'x-raw', 'label': 'Raw Video'}
+			],
+			'fps': [],
+			'videoEncoding': [
+				{'value': 'h264', 'label': 'H.264'},
+				{'value': 'vp8', 'label': 'VP8'}
+			],
+			'video_rotation': [
+				{'value': '0', 'label': 'No Rotation'},
+				{'value': '1', 'label': 'Rotate 90 degrees to the right'},
+				{'value': '3', 'label': 'Rotate 90 degrees to the left'},
+				{'value': '4', 'label': 'Flip horizontally'},
+				{'value': '2', 'label': 'Flip vertically'}
+
+			]
+		}
+
+		self._localPeers = set()
+		self._localPeersLock = Lock()
 		self._localPeersResponseWaiting = Lock()
-		self.waitForPhoto = Event()
+
+		#Latest frame is double buffered and never consumed, so all local peers can get it
+		self._frameSlots = [None, None]
+		self._activeSlot = 0
+		self._frameCount = 0
+		self._frameCondition = Condition()
+		self._peersLastFrame = {} # frame count last sent to each peer
 
 	@property
 	def _gstreamerProcessRunning(self):
@@ -84,7 +124,7 @@ class GStreamerManager(V4L2Manager):
 
 	def _haltCamera(self):
 		self.close_camera()
-		webRtcManager().closeAllSessions()
+		self._webRtc.closeAllSessions()
 
 	def _doReScan(self):
 		if super(GStreamerManager, self)._doReScan():
@@ -102,41 +142,74 @@ class GStreamerManager(V4L2Manager):
 	def addLocalPeerReq(self):
 		id = uuid.uuid4().hex
 
-		self._localPeers.append(id)
+		with self._frameCondition:
+			self._peersLastFrame[id] = self._frameCount # new peers wait for a fresh frame
 
-		self._logger.debug('number of local peers: %d' % len(self._localPeers))
+		with self._localPeersLock:
+			self._localPeers.add(id)
+			numberOfPeers = len(self._localPeers)
 
-		if len(self._localPeers) == 1:
+		self._logger.debug('number of local peers: %d' % numberOfPeers)
+
+		if numberOfPeers == 1:
 			self.start_local_video_stream()
 
 		return id
 
 	def removeLocalPeerReq(self,id):
-		self._localPeers.remove(id)
+		with self._localPeersLock:
+			self._localPeers.discard(id)
+			numberOfPeers = len(self._localPeers)
+
+		with self._frameCondition:
+			self._peersLastFrame.pop(id, None)
 
-		if len(self._localPeers) <= 0:
+		if numberOfPeers <= 0:
 			self.stop_local_video_stream()
 			self._logger.info('There are 0 local peers left')
 
 	def removeAllLocalPeerReqs(self):
-		self._localPeers = []
+		with self._localPeersLock:
+			self._localPeers.clear()
+
+		with self._frameCondition:
+			self._peersLastFrame.clear()
+
 		self._logger.info('There are 0 local peers left')
 
 
 	def getFrame(self,id):
-		self.waitForPhoto.wait(3)
-		if self.waitForPhoto.isSet():
-			self.waitForPhoto.clear()
+		#Return the latest frame right away if this peer hasn't seen it, otherwise wait for the next one
+		with self._frameCondition:
+			lastFrame = self._peersLastFrame.get(id)
+			timeout = time.time() + 3.0
+
+			while self._frameCount == lastFrame:
+				remaining = timeout - time.time()
+				if remaining <= 0:
+					break
+
+				self._frameCondition.wait(remaining)
+
+			newFrame = self._frameCount != lastFrame
+
+			if newFrame:
+				frame = self._frameSlots[self._activeSlot]
+				if id in self._peersLastFrame:
+					self._peersLastFrame[id] = self._frameCount
+
+		if newFrame:
 			if id in self._localPeers:
-				return self._localFrame
+				return frame
 		else:#auto set after time
 			self.removeLocalPeerReq(id)
 			self.eventManager.fire(Events.LOCAL_VIDEO_STREAMING_STOPPED,None)
-			self.waitForPhoto.clear()
 			return None
 
 	def _responsePeersReq(self,photoData):
-		self._localFrame = photoData
+		inactiveSlot = self._activeSlot ^ 1
+		self._frameSlots[inactiveSlot] = photoData
+		self._activeSlot = inactiveSlot
 
 	def _onFrameTakenCallback(self,photoData):
 
@@ -145,9 +218,10 @@ class GStreamerManager(V4L2Manager):
 			if not self._localPeers:
 				self.stop_local_video_stream()
 
-			self._responsePeersReq(photoData)
-
-			self.waitForPhoto.set()
+			with self._frameCondition:
+				self._responsePeersReq(photoData)
+				self._frameCount += 1
+				self._frameCondition.notify_all()
 
 	def start_local_video_stream(self):
 
@@ -199,10 +273,12 @@ class GStreamerManager(V4L2Manager):
 	def settingsChanged(self, cameraSettings):
 		super(GStreamerManager, self).settingsChanged(cameraSettings)
 
+		self._cachedCapabilities = ['videoStreaming', 'videoformat-' + self._settings['encoding']]
+
 		##When a change in settup is saved, the camera must be shouted down
 		##(Janus included, of course)
 
-		eventManager().fire(Events.GSTREAMER_EVENT, {
+		self.eventManager.fire(Events.GSTREAMER_EVENT, {
 			'message': 'Your camera settings have been changed. Please reload to restart your video.'
 		})
 		##
@@ -226,60 +302,42 @@ class GStreamerManager(V4L2Manager):
 		self._logger.info('Shutting Down GstreamerManager')
 		self._freeApPipeline()
 		self._haltCamera()
-		webRtcManager().shutdown()
+		self._webRtc.shutdown()
 
 	def isVideoStreaming(self):
 		if self._gstreamerProcessRunning:
-			waitForDone = Event()
-			respCont = [None]
+			with self._pipelineStateCondition:
+				#Requests are numbered so a late reply to a request that timed out is ignored
+				self._pipelineStateReqId += 1
+				self._pipelineStateResp = None
+				self._apPipeline.isAnyVideoPlaying(partial(self._onPipelineState, self._pipelineStateReqId))
 
-			def onDone(isPlaying):
-				if not waitForDone.is_set():
-					respCont[0] = isPlaying
+				timeout = time.time() + 1.0
+				while self._pipelineStateResp is None:
+					remaining = timeout - time.time()
+					if remaining <= 0:
+						break
 
-			self._apPipeline.isAnyVideoPlaying(onDone)
+					self._pipelineStateCondition.wait(remaining)
 
-
-			waitForDone.wait(1.0)
-
-			return respCont[0] is True
+				return self._pipelineStateResp is True
 
 		else:
 			return False
 
+	def _onPipelineState(self, reqId, isPlaying):
+		with self._pipelineStateCondition:
+			if reqId == self._pipelineStateReqId:
+				self._pipelineStateResp = isPlaying
+				self._pipelineStateCondition.notify_all()
+
 	def closeLocalVideoSession(self, sessionId):
-		return webRtcManager().closeLocalSession(sessionId)
+		return self._webRtc.closeLocalSession(sessionId)
 
 	@property
 	def capabilities(self):
-		return ['videoStreaming', 'videoformat-' + self._settings['encoding']]
+		return self._cachedCapabilities
 
 	@property
 	def _desiredSettings(self):
-		return {
-			'busSource': [
-				{'value': 'USB', 'label': 'USB Camera'},
-				{'value': 'raspicam', 'label': 'Raspicam'}
-			],
-			'frameSizes': [
-				{'value': '640x480', 'label': 'Low (640 x 480)'},
-				{'value': '1280x720', 'label': 'HD 720p (1280 x 720)'},
-				{'value': '1920x1080', 'label': 'HD 1080p (1920 x 1080)'}
-			],
-			'cameraOutput': [
-				{'value': 'x-raw', 'label': 'Raw Video'}
-			],
-			'fps': [],
-			'videoEncoding': [
-				{'value': 'h264', 'label': 'H.264'},
-				{'value': 'vp8', 'label': 'VP8'}
-			],
-			'video_rotation': [
-				{'value': '0', 'label': 'No Rotation'},
-				{'value': '1', 'label': 'Rotate 90 degrees to the right'},
-				{'value': '3', 'label': 'Rotate 90 degrees to the left'},
-				{'value': '4', 'label': 'Flip horizontally'},
-				{'value': '2', 'label': 'Flip vertically'}
-
-			]
-		}
+		return self._cachedDesiredSettings
@@ -8,13 +8,42 @@ import threading
 import os
 import time
 import json
+import re
 
 from sys import platform
 
 from collections import deque
+from functools import partial
+from Queue import Queue, Full
 
 from .transport import TransportEvents
 
+#
+# posix_fadvise is only in the os module from python 3.3, use libc directly on linux
+#
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+if hasattr(os, 'posix_fadvise'):
+	_fadvise = os.posix_fadvise
+
+elif 'linux' in platform:
+	try:
+		import ctypes
+		import ctypes.util
+
+		_libcFadvise = ctypes.CDLL(ctypes.util.find_library('c')).posix_fadvise64
+		_libcFadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+
+		def _fadvise(fd, offset, length, advice):
+			_libcFadvise(fd, offset, length, advice)
+
+	except (ImportError, OSError, AttributeError):
+		_fadvise = None
+
+else:
+	_fadvise = None
+
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # CommsListener: Callback interface for CommandsComms Users
@@ -77,6 +106,8 @@ class CommsListener(object):
 	#
 	# - RETURN: an list containing the resulting command object sequence after the translation, or None if the line is to be ignored
 	#
+	# Use Command.obtain() to create the command objects so they're recycled once sent and completed
+	#
 	def onFileLineRead(self, line):
 		return None
 
@@ -229,13 +260,121 @@ class CommandPluginInterface(object):
 # Command: Base class for the command object
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+COMMAND_POOL_SIZE = 4096
+
+#Type tags of the objects in the command queue
+TYPE_COMMAND = 0
+TYPE_SIGNAL = 1
+
+_GCODE_RE = re.compile(r'^\s*(?:N\d+\s*)?(?P<cmd>[GMT]\d+(?:\.\d+)?)(?P<rest>[^;*]*)', re.I)
+_PARAM_RE = re.compile(r'([A-Z])([-+]?\d*\.?\d*)', re.I)
+
+#Commands that take a string argument (file names, messages) instead of parameters
+_STRING_ARG_COMMANDS = frozenset(['M23', 'M28', 'M30', 'M32', 'M117', 'M118'])
+
+#
+# Tokenizes a G-code line in a single pass so commands don't need to parse it with string operations
+#
+# - line: the G-code line
+#
+# Returns: a tuple (command, params) with the command in uppercase ('G1', 'M104', 'T0', 'G38.2'...) and a dict of the
+# parameters keyed by their uppercase letter ({'X': 10.0, 'E': 1.5}). Parameters without a value map to None ('G28 X Y'
+# gives {'X': None, 'Y': None}). Commands that take a string argument (M23, M28, M30, M32, M117, M118) get an empty dict,
+# their argument has to be read from the line. Returns (None, None) if the line is not a G, M or T command
+#
+def parse_gcode(line):
+	m = _GCODE_RE.match(line)
+	if m is None:
+		return None, None
+
+	cmd = m.group('cmd').upper()
+	params = {}
+
+	rest = m.group('rest')
+	if rest and cmd not in _STRING_ARG_COMMANDS:
+		for k, v in _PARAM_RE.findall(rest):
+			try:
+				params[k.upper()] = float(v)
+			except ValueError:
+				params[k.upper()] = None # no value (or just a sign/dot)
+
+	return cmd, params
+
+_commandPools = {} # Free lists of recycled commands, one per Command class
+_commandPoolsLock = threading.Lock()
+
 class Command(object):
+	#There's one of these per line in a print job. Subclasses that don't declare __slots__ still get a __dict__
+	__slots__ = ('_command', '_encoded', '_completed', '_received', 'isQueued', '_pooled', '_sent', '_finished')
+
+	_typeTag = TYPE_COMMAND
+
 	def __init__(self, command):
 		self._command = command
 		self._encoded = None
 		self._completed = False
 		self._received = False
 		self.isQueued = False #Indicates that the command is queued
+		self._pooled = False #Indicates that the command can be recycled when completed
+		self._sent = False #The write of the command finished and onCommandSent was called
+		self._finished = False #The command completed and it's no longer pending
+
+	#
+	# Returns a command of this class, reusing a recycled one if available. The arguments are passed to __init__,
+	# which needs to reset all the state of the command.
+	#
+	# Only commands created with this function are recycled once they've been sent and completed, so don't keep references to them
+	#
+	@classmethod
+	def obtain(cls, *args, **kwargs):
+		pool = _commandPools.get(cls)
+
+		try:
+			c = pool.pop()
+
+		except (AttributeError, IndexError):
+			c = cls.__new__(cls)
+
+		c.__init__(*args, **kwargs)
+		c._pooled = True
+
+		return c
+
+	#
+	# Called by the sender when the write is done. Use this instead of onCommandSent as the write completed callback
+	#
+	def _onSent(self):
+		self.onCommandSent()
+		self._sent = True
+		self._recycleIfDone()
+
+	#
+	# Called by the sender once the command completed and was removed from the pending list
+	#
+	def _onFinished(self):
+		self._finished = True
+		self._recycleIfDone()
+
+	#
+	# The write completion and the response can come in any order and from different threads, recycle after the last one
+	#
+	def _recycleIfDone(self):
+		if self._pooled:
+			with _commandPoolsLock:
+				if not (self._pooled and self._sent and self._finished):
+					return
+
+				self._pooled = False
+
+			self._addToPool()
+
+	def _addToPool(self):
+		cls = self.__class__
+		pool = _commandPools.get(cls)
+		if pool is None:
+			pool = _commandPools.setdefault(cls, deque(maxlen= COMMAND_POOL_SIZE))
+
+		pool.append(self)
 
 	def __eq__(self, otherCmd):
 		return otherCmd == self._command
@@ -278,6 +417,8 @@ class Command(object):
 	#
 	# Returns: a list of commands to be put in the queue, False if there's no translation, or None if the command sholdn't be put in the queue
 	#
+	# Use parse_gcode() to tokenize the command instead of parsing it with string operations
+	#
 	def translateCommand(self):
 		return False # Means the command doesn't change
 		#return None # Means the command shouldn't be put in the queue
@@ -321,7 +462,11 @@ class Command(object):
 	#
 	# Implement what should happen when responses are retrieved after sending this command
 	#
-	def onResponse(self):
+	# - data: the stripped response line as a byte string (not decoded). Compare it with byte literals, e.g. data.startswith(b'ok')
+	#
+	# Returns: True if the response was handled by this command
+	#
+	def onResponse(self, data):
 		raise NotImplementedError()
 
 
@@ -331,6 +476,10 @@ class Command(object):
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class Signal(Command):
+	__slots__ = ('_type', '_data')
+
+	_typeTag = TYPE_SIGNAL
+
 	def __init__(self, signalType, data):
 		super(Signal, self).__init__(None)
 
@@ -359,10 +508,13 @@ class CommandsComms(TransportEvents):
 		self._listener = listener
 		self._logger = logging.getLogger(self.__class__.__name__)
 		self._serialLogger = logging.getLogger("SERIAL")
-		self._serialLoggerEnabled = self._serialLogger.isEnabledFor(logging.DEBUG)
 		self._statusPoller = None
 		self._printJob = None
 		self._sender = None
+		self._responseProcessor = None
+		self._txLock = threading.Lock()
+		self._txBuffer = [] # (data, completed, failed) writes waiting for the current write to finish
+		self._txWriting = False
 
 		if transport == 'serial':
 			from .transport.serial_t import SerialCommTransport
@@ -439,7 +591,7 @@ class CommandsComms(TransportEvents):
 	#
 	@property
 	def serialLogEnabled(self):
-		return self._serialLoggerEnabled
+		return self._serialLogger.isEnabledFor(logging.DEBUG)
 
 	#
 	# Add the commands to the send queue
@@ -477,10 +629,11 @@ class CommandsComms(TransportEvents):
 			self._sender.addCommandIfNotExists(command, sendNext)
 
 	#
-	# Report that the serial logging has changed
+	# Report that the serial logging has changed. Nothing to do as the logger checks its level
+	# on every call, it's kept for the plugins that call it.
 	#
 	def serialLoggingChanged(self):
-		self._serialLoggerEnabled = self._serialLogger.isEnabledFor(logging.DEBUG)
+		pass
 
 	#
 	# Sends next command in queue
@@ -499,16 +652,107 @@ class CommandsComms(TransportEvents):
 	#
 	# write 'data' on the underlying link
 	#
-	def writeOnLink(self, data, completed= None):
+	# Writes requested while another thread is writing are coalesced and sent by that thread in a single transport write
+	#
+	# - completed: called once the data is written
+	# - failed: called with the error if the data couldn't be written by another thread. Failures of this thread's
+	#   own write are raised instead. Without it the failure is reported to the listener
+	#
+	def writeOnLink(self, data, completed= None, failed= None):
 		if data is not None:
-			def sendCompleted():
-				self._serialLoggerEnabled and self.writeToSerialLog('S: %r' % data)
+			ownWrite = (data, completed, failed)
+
+			with self._txLock:
+				self._txBuffer.append(ownWrite)
+
+				if self._txWriting:
+					return
+
+				self._txWriting = True
+
+			ownError = None
+			drained = False
+
+			try:
+				while True:
+					with self._txLock:
+						writes = self._txBuffer
+						if not writes:
+							self._txWriting = False
+							drained = True
+							break
+
+						self._txBuffer = []
+
+					for batch in self._coalesceWrites(writes):
+						try:
+							self._writeBatch(batch)
+
+						except Exception as e:
+							#The error is raised to our caller, the other writers already returned so they're told through their callback
+							for w in batch:
+								if w is ownWrite:
+									ownError = e
+								else:
+									self._reportFailedWrite(w, e)
+
+			finally:
+				if not drained:
+					with self._txLock:
+						stranded = self._txBuffer
+						self._txBuffer = []
+						self._txWriting = False
+
+					for w in stranded:
+						self._reportFailedWrite(w, 'write aborted')
+
+			if ownError is not None:
+				raise ownError
+
+	#
+	# Splits the writes in batches that can be sent with a single transport write
+	#
+	def _coalesceWrites(self, writes):
+		if len(writes) > 1:
+			try:
+				b''.join([w[0] for w in writes])
+
+			except TypeError:
+				#Mixed data types, can't be coalesced
+				return [[w] for w in writes]
+
+		return [writes]
+
+	def _writeBatch(self, batch):
+		if len(batch) > 1:
+			data = b''.join([w[0] for w in batch])
+		else:
+			data = batch[0][0]
+
+		def sendCompleted():
+			for d, completed, _ in batch:
+				self._serialLogger.debug('S: %r', d)
 				if completed:
-					completed()
+					try:
+						completed()
+					except:
+						self._logger.error('Error in write completed callback', exc_info= True)
+
+				self._listener.onDataSent(d)
+
+		self._transport.write(data, sendCompleted)
 
-				self._listener.onDataSent(data)
+	def _reportFailedWrite(self, write, error):
+		data, _, failed = write
 
-			self._transport.write(data, sendCompleted)
+		if failed:
+			try:
+				failed(error)
+			except:
+				self._logger.error('Error in write failed callback', exc_info= True)
+
+		else:
+			self._listener.onLinkError('unable_to_send', "Error: %s, data: %r" % (error, data))
 
 	#
 	# Starts status poller
@@ -533,6 +777,10 @@ class CommandsComms(TransportEvents):
 		if not self._sender:
 			self._sender = CommandSender(self, self._listener)
 
+		if not self._responseProcessor:
+			self._responseProcessor = ResponseProcessor(self)
+			self._responseProcessor.start()
+
 	#
 	# Stops the sender
 	#
@@ -540,6 +788,15 @@ class CommandsComms(TransportEvents):
 		if self._sender:
 			self._sender = None
 
+		self._stopResponseProcessor()
+
+	def _stopResponseProcessor(self):
+		responseProcessor = self._responseProcessor
+
+		if responseProcessor:
+			self._responseProcessor = None
+			responseProcessor.stop()
+
 	#
 	# Set Paused of the status poller
 	#
@@ -614,32 +871,63 @@ class CommandsComms(TransportEvents):
 	# TransportEvents ~
 	# ~~~~~~~~~~~~~~~~~
 
+	#
+	# Processing is handed off to the ResponseProcessor so the transport can keep reading
+	#
 	def onDataReceived(self, data):
-		self._serialLoggerEnabled and self.writeToSerialLog('R: %r' % data)
+		responseProcessor = self._responseProcessor
+
+		if responseProcessor:
+			responseProcessor.addData(data)
+		else:
+			self.processReceivedData(data)
+
+	#
+	# Called from the ResponseProcessor with the data received from the link
+	#
+	def processReceivedData(self, data):
+		self._serialLogger.debug('R: %r', data)
 
 		if self._sender:
 			self._sender.onCommandResponse(data)
 
 	def onLinkError(self, error, description= None):
+		self._stopResponseProcessor()
 		self._listener.onLinkError(error, description)
 		self._transport.closeLink()
 
 	def onLinkClosed(self):
+		self._stopResponseProcessor()
 		self._listener.onLinkClosed()
 
 	def onLinkOpened(self):
 		self.startSender()
 		self._listener.onLinkOpened()
 
+	#
+	# Also handed off to the ResponseProcessor, so the listener gets it after the responses received before it
+	#
 	def onLinkInfo(self, info):
+		responseProcessor = self._responseProcessor
+
+		if responseProcessor:
+			responseProcessor.addLinkInfo(info)
+		else:
+			self.processLinkInfo(info)
+
+	#
+	# Called from the ResponseProcessor with the info reported by the link
+	#
+	def processLinkInfo(self, info):
 		self._listener.onLinkInfo(info)
-		self._serialLoggerEnabled and self.writeToSerialLog(info)
+		self._serialLogger.debug('%s', info)
 
 
 #~~~~~~ Worker to read commands from file
 
 class JobWorker(threading.Thread):
 	_reportProgressInterval = 1.0
+	_readBlockSize = 1048576
 
 	def __init__(self, filename, comm, eventListener): #eventListener is object of interface CommsListener
 		super(JobWorker, self).__init__()
@@ -650,21 +938,18 @@ class JobWorker(threading.Thread):
 		self._stopped = False
 		self._fileHandler = None
 		self._fileSize = None
+		self._bytesRead = 0
+		self._lineIter = None
 		self._readEvent = threading.Event()
 		self._lastReport = None
 
 	def run(self):
 		while not self._stopped:
-			if ( time.time() - self._lastReport ) >= self._reportProgressInterval:
-				filePos = self.filePos
-				percent = filePos / self._fileSize
-				self._eventListener.onPrintJobProgress( percent, filePos )
-				self._lastReport = time.time()
-
 			self._readEvent.wait()
 			addedCommands = 0
 			while not self._stopped:
-				line = self._fileHandler.readline()
+				line = next(self._lineIter, '')
+				self._bytesRead += len(line)
 				if line == '':
 					# end of file reached
 					self.stop()
@@ -686,6 +971,14 @@ class JobWorker(threading.Thread):
 							self._readEvent.clear()
 							break
 
+			#Report after the lines have been read so the progress is current
+			if not self._stopped:
+				now = time.time()
+				if ( now - self._lastReport ) >= self._reportProgressInterval:
+					filePos = self._bytesRead
+					self._eventListener.onPrintJobProgress( filePos / self._fileSize, filePos )
+					self._lastReport = now
+
 	def stop(self):
 		if not self._stopped:
 			self._stopped = True
@@ -695,7 +988,10 @@ class JobWorker(threading.Thread):
 
 	def start(self):
 		#open the file
-		self._fileHandler = open(self._filename, 'r')
+		self._fileHandler = open(self._filename, 'rb')
+		self._adviseFile(0, POSIX_FADV_SEQUENTIAL) # read ahead aggressively
+		self._bytesRead = 0
+		self._lineIter = self._readLines()
 		self._readEvent.clear()
 		self._fileSize = float(os.stat(self._filename).st_size)
 		self._eventListener.onPrintJobProgress(0.0, 0)
@@ -707,10 +1003,50 @@ class JobWorker(threading.Thread):
 		self._maxCommands = maxCommands
 		self._readEvent.set()
 
+	#
+	# Generator of the lines in the file, line endings included. The file is read in large blocks
+	# to avoid a readline() call per line
+	#
+	def _readLines(self):
+		tail = ''
+		offset = 0
+
+		while True:
+			block = self._fileHandler.read(self._readBlockSize)
+			if not block:
+				if tail:
+					yield tail
+
+				return
+
+			#The file is read once, drop what we've consumed from the page cache
+			offset += len(block)
+			self._adviseFile(offset, POSIX_FADV_DONTNEED)
+
+			#Split on \n only, like readline() does (splitlines() would also split on a lone \r)
+			lines = (tail + block).split('\n')
+
+			#The last line is incomplete (or empty if the block ended in \n), keep it for the next block
+			tail = lines.pop()
+
+			for line in lines:
+				yield line + '\n'
+
+	#
+	# Gives an access pattern hint to the kernel for the file from its start up to length (0 means the whole file)
+	#
+	def _adviseFile(self, length, advice):
+		if _fadvise:
+			try:
+				_fadvise(self._fileHandler.fileno(), 0, length, advice)
+			except (OSError, ValueError):
+				pass
+
 	@property
 	def filePos(self):
+		#Kept in memory to avoid calling tell() on every progress report
 		if self._fileHandler:
-			return self._fileHandler.tell()
+			return self._bytesRead
 		else:
 			return None
 
@@ -720,33 +1056,103 @@ class StatusPoller(threading.Thread):
 	def __init__(self, eventListener, interval=5.0):
 		super(StatusPoller, self).__init__()
 		self._stopped = False
+		self._paused = False
 		self._interval = interval
 		self._eventListener = eventListener
-		self._event = threading.Event()
-		self._pauseEvent = threading.Event()
-		self._pauseEvent.set()
+		self._cond = threading.Condition()
 
 	def run(self):
-		while not self._stopped:
+		while True:
+			with self._cond:
+				#A paused poller sleeps until it's resumed or stopped
+				while self._paused and not self._stopped:
+					self._cond.wait()
+
+				if self._stopped:
+					break
+
 			self._eventListener.onStatusCommandsNeeded()
-			self._event.wait(self._interval)
-			self._pauseEvent.wait()
+
+			with self._cond:
+				if not self._stopped:
+					self._cond.wait(self._interval)
 
 	def stop(self):
-		self._stopped = True
-		self._pauseEvent.set()
-		self._event.set()
+		with self._cond:
+			self._stopped = True
+			self._cond.notify_all()
 
 	@property
 	def paused(self):
-		return not self._pauseEvent.is_set()
+		return self._paused
 
 	@paused.setter
 	def paused(self, paused):
-		if paused:
-			self._pauseEvent.clear()
-		else:
-			self._pauseEvent.set()
+		paused = bool(paused)
+
+		with self._cond:
+			if paused != self._paused:
+				self._paused = paused
+				self._cond.notify_all()
+
+#~~~~~~ Worker to process the data received from the link
+
+class ResponseProcessor(threading.Thread):
+	_queueSize = 256
+
+	def __init__(self, comms):
+		super(ResponseProcessor, self).__init__()
+		self.daemon = True
+		self._logger = logging.getLogger(self.__class__.__name__)
+		self._stopped = False
+		self._comms = comms
+		self._queue = Queue(self._queueSize)
+
+	def run(self):
+		while not self._stopped:
+			item = self._queue.get()
+
+			if item is not None and not self._stopped:
+				process, data = item
+
+				try:
+					process(data)
+				except:
+					self._logger.error('Error processing received data [%r]' % data, exc_info= True)
+
+	#
+	# Queues data to be processed. If the queue is full it blocks the caller until there's room, so
+	# responses are never processed out of order
+	#
+	# Returns: False if the processor was stopped and the data was discarded
+	#
+	def addData(self, data):
+		return self._add((self._comms.processReceivedData, data))
+
+	#
+	# Queues link info, so it's reported in order with the data received before it
+	#
+	def addLinkInfo(self, info):
+		return self._add((self._comms.processLinkInfo, info))
+
+	def _add(self, item):
+		while not self._stopped:
+			try:
+				self._queue.put(item, True, 0.5)
+				return True
+
+			except Full:
+				pass # check that we haven't been stopped while waiting
+
+		return False
+
+	def stop(self):
+		self._stopped = True
+
+		try:
+			self._queue.put_nowait(None) # wake up the thread
+		except Full:
+			pass # it's busy and will see the stopped flag after the current item
 
 #~~~~~~ Worker to empty the command queue
 
@@ -757,7 +1163,10 @@ class CommandSender(object):
 		self._stopped = False
 		self._eventListener = eventListener
 		self._comms = comms
-		self._commandQ = deque()
+		self._commandQ = deque() # Head on the left. Single item deque operations are atomic, no lock needed for them
+		self._commandQCounts = {} # How many times each command string is in the queue, for addCommandIfNotExists
+		self._commandQCountsLock = threading.Lock()
+		self._commandQBulkLock = threading.Lock() # Only used for the operations that work on the whole queue
 		self._readyToSend = True
 		self._storedCommands = None
 		self._pendingCommands = deque()
@@ -767,49 +1176,70 @@ class CommandSender(object):
 		self._readyToSend = False
 
 		try:
-			command = self._commandQ.pop()
+			command = self._commandQ.popleft()
 
 		except IndexError:
+			with self._commandQCountsLock:
+				self._commandQCounts.clear() # in case an entry was left behind by a race with the bulk operations
+
 			self._readyToSend = True
 			return
 
+		self._uncountQueued(command)
+
 		if command:
-			if isinstance(command, Signal):
+			tag = command._typeTag
+
+			if tag == TYPE_COMMAND:
+				self.sendCommand(command)
+
+			elif tag == TYPE_SIGNAL:
 				#This is a signal placed in the queue, we tell the event listener and move on
 				self._eventListener.onSignalReceived( command.type, command.data )
 				self.fireNextCommand()
 
-			elif isinstance(command, Command):
-				self.sendCommand(command)
-
 			else:
-				self._logger.warn("The following invalid command type was found in the queue: %r" % command)
+				self._logger.warn("The following command with an invalid type tag was found in the queue: %r" % command)
 
 
 	def sendCommand(self, command):
 		if command.onBeforeCommandSend() is not False:
+			#It needs to be pending before it's written or the response could arrive first
+			with self._pendingCommmandsLock:
+				self._pendingCommands.appendleft(command)
+
 			try:
-				self._comms.writeOnLink(command.encodedCommand, command.onCommandSent)
-				with self._pendingCommmandsLock:
-					self._pendingCommands.appendleft(command)
+				self._comms.writeOnLink(command.encodedCommand, command._onSent, partial(self._onCommandWriteFailed, command))
 
 			except Exception as e:
-				self._eventListener.onLinkError('unable_to_send', "Error: %s, command: %s" % (e, command.command))
+				self._onCommandWriteFailed(command, e)
 
 		else:
 			self.sendNext()
 
+	#
+	# The command couldn't be written, either by this thread or by another one that coalesced it with its own write
+	#
+	def _onCommandWriteFailed(self, command, error):
+		self._removePendingCommand(command)
+		self._eventListener.onLinkError('unable_to_send', "Error: %s, command: %s" % (error, command.command))
+
 	def onCommandResponse(self, data):
 		if data:
 			try:
-				data = data.decode('ascii').strip()
+				#Keep it as bytes, most responses are just checked for a prefix. USB transports give a bytearray
+				data = bytes(data).strip()
 
 				toBeRemoved = None
 				sendNext = False
 				handled = False
 
 				with self._pendingCommmandsLock:
-					pc = list(self._pendingCommands)
+					#Most of the time there's only one command in flight, avoid copying the queue for it
+					if len(self._pendingCommands) == 1:
+						pc = (self._pendingCommands[0],)
+					else:
+						pc = list(self._pendingCommands)
 
 				for c in pc:
 					if c.onResponse(data):
@@ -823,11 +1253,11 @@ class CommandSender(object):
 						break
 
 				if not handled:
-					self._eventListener.onUnhandledResponse(data)
+					self._eventListener.onUnhandledResponse(data.decode('ascii', 'replace'))
 
 				if toBeRemoved:
-					with self._pendingCommmandsLock:
-						self._pendingCommands.remove(toBeRemoved)
+					self._removePendingCommand(toBeRemoved)
+					toBeRemoved._onFinished()
 
 				if sendNext:
 					self.sendNext()
@@ -835,14 +1265,52 @@ class CommandSender(object):
 			except:
 				self._logger.error('Error handling data received.', exc_info= True)
 
+	#
+	# Removes a command from the pending list. Commands are matched by identity,
+	# as Command.__eq__ compares the command strings and several equal commands can be in flight
+	#
+	def _removePendingCommand(self, command):
+		with self._pendingCommmandsLock:
+			pending = self._pendingCommands
+
+			if not pending:
+				return
+
+			if pending[0] is command:
+				pending.popleft()
+
+			elif pending[-1] is command:
+				pending.pop()
+
+			else:
+				for i, c in enumerate(pending):
+					if c is command:
+						del pending[i]
+						break
+
 	def storeCommands(self):
-		self._storedCommands = list(self._commandQ)
-		self._commandQ.clear()
+		with self._commandQBulkLock:
+			#Drained one popleft at a time: concurrent adds and sends don't take the lock, and each pop is atomic
+			#so a command is never lost or both sent and stored
+			stored = []
+
+			while True:
+				try:
+					command = self._commandQ.popleft()
+				except IndexError:
+					break
+
+				self._uncountQueued(command)
+				stored.append(command)
+
+			self._storedCommands = stored
 
 	def restoreCommands(self):
-		if self._storedCommands:
-			self._commandQ.extend(self._storedCommands)
-			self._storedCommands = None
+		with self._commandQBulkLock:
+			if self._storedCommands:
+				self._countQueued(self._storedCommands)
+				self._commandQ.extendleft(reversed(self._storedCommands))
+				self._storedCommands = None
 
 	def sendNext(self):
 		if self._readyToSend:
@@ -871,10 +1339,13 @@ class CommandSender(object):
 			commandCount = len(commands)
 
 			if commandCount:
+				#Counted before they are queued so fireNextCommand never finds a command that isn't counted yet
+				self._countQueued(commands)
+
 				if sendNext:
-					self._commandQ.extend(commands)
+					self._commandQ.extendleft(reversed(commands))
 				else:
-					self._commandQ.extendleft(commands)
+					self._commandQ.extend(commands)
 
 				for c in commands:
 					c.encode()
@@ -885,14 +1356,44 @@ class CommandSender(object):
 					self.sendNext()
 
 	def addCommandIfNotExists(self, command, sendNext= False):
-		if command not in self._commandQ:
+		if command._command not in self._commandQCounts:
 			self.addCommands([command], sendNext)
 
+	#
+	# Keeps the count of each command string in the queue. Keys are deleted when they reach zero
+	#
+	def _countQueued(self, commands):
+		counts = self._commandQCounts
+
+		with self._commandQCountsLock:
+			for c in commands:
+				counts[c._command] = counts.get(c._command, 0) + 1
+
+	def _uncountQueued(self, command):
+		counts = self._commandQCounts
+
+		with self._commandQCountsLock:
+			count = counts.get(command._command)
+
+			if count is not None: # it's missing if the queue was cleared after the command was taken
+				if count > 1:
+					counts[command._command] = count - 1
+				else:
+					del counts[command._command]
+
 	def clearCommandQueue(self):
-		self._commandQ.clear()
+		with self._commandQBulkLock:
+			self._commandQ.clear()
+
+			with self._commandQCountsLock:
+				self._commandQCounts.clear()
+
 		with self._pendingCommmandsLock:
 			self._pendingCommands.clear()
 
+	#
+	# Advisory only: the queue is not locked so it can change right after this is read
+	#
 	@property
 	def commandsInQueue(self):
 		return len(self._commandQ)
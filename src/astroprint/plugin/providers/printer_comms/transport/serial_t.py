@@ -169,22 +169,41 @@ class LinkReader(threading.Thread):
 		self._eventListener = eventListener
 		self._link = link
 
+	#
+	# Reads whatever is waiting in the port and splits it in lines. Serial.readline() reads a byte at
+	# a time, paying for a syscall and the GIL for each of them
+	#
 	def run(self):
+		pending = ''
+
 		while not self._stopped:
 			try:
-				line = self._link.readline()
+				data = self._link.read(self._link.in_waiting or 1)
 			except:
-				line = None
+				data = None
 
 			if not self._stopped:
-				if line is None:
+				if data is None:
 					self._eventListener.onLinkError('invalid_link', "Line returned nothing")
 					self.stop()
-				else:
-					if line is '':
-						self._eventListener.onLinkInfo('timeout')
+
+				elif data == '':
+					if pending:
+						#timed out in the middle of a line, pass it on as readline() did
+						self._eventListener.onDataReceived(pending)
+						pending = ''
 					else:
-						self._eventListener.onDataReceived(line)
+						self._eventListener.onLinkInfo('timeout')
+
+				else:
+					pending += data
+
+					if '\n' in data:
+						lines = pending.split('\n')
+						pending = lines.pop()
+
+						for line in lines:
+							self._eventListener.onDataReceived(line + '\n')
 
 	def stop(self):
 		self._stopped = True